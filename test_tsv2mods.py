@@ -0,0 +1,160 @@
+"""Tests for tsv2mods"""
+import csv
+import itertools
+import logging
+import multiprocessing
+import ntpath
+import os
+import posixpath
+import tempfile
+import unittest
+from unittest import mock
+
+import tsv2mods
+
+
+class ModsFilenameTest(unittest.TestCase):
+    """mods_filename matches the os.path split and splitext it replaces"""
+
+    def check(self, path_module, alphabet):
+        for length in range(6):
+            for chars in itertools.product(alphabet, repeat=length):
+                value = ''.join(chars)
+                expected = path_module.splitext(path_module.split(value)[1])[0] + '.mods'
+                self.assertEqual(expected, tsv2mods.mods_filename(value), value)
+
+    def test_posix(self):
+        with mock.patch('os.sep', '/'), mock.patch('os.altsep', None), mock.patch('os.path', posixpath):
+            self.check(posixpath, 'a./\\')
+
+    def test_windows(self):
+        with mock.patch('os.sep', '\\'), mock.patch('os.altsep', '/'), mock.patch('os.path', ntpath):
+            self.check(ntpath, 'a./\\:')
+
+
+class ProcessFileTest(unittest.TestCase):
+    """Run process_file on a TSV in a temporary directory"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        tsv2mods.setup_log('ERROR')
+        tsv2mods.include_empty_tags = False
+        tsv2mods.overwrite = False
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+        logger = logging.getLogger('tsv2mods')
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+
+    def process(self, lines, workers=4):
+        with open('input.tsv', 'w', encoding='utf-8') as fp:
+            fp.write(''.join(line + '\n' for line in lines))
+        with mock.patch('os.cpu_count', return_value=workers):
+            tsv2mods.process_file(os.path.abspath('input.tsv'))
+
+    def read(self, filename):
+        with open(filename, encoding='utf-8') as fp:
+            return fp.read()
+
+    def test_duplicate_filenames_keep_first_row(self):
+        self.process(['Filename\t/mods:titleInfo/mods:title'] +
+                     ['dup.jpg\trow {}'.format(n) for n in range(500)])
+        self.assertIn('<mods:title>row 0</mods:title>', self.read('dup.mods'))
+
+    def test_duplicate_filenames_overwrite_keeps_last_row(self):
+        tsv2mods.overwrite = True
+        self.process(['Filename\t/mods:titleInfo/mods:title'] +
+                     ['dup.jpg\trow {}'.format(n) for n in range(500)])
+        self.assertIn('<mods:title>row 499</mods:title>', self.read('dup.mods'))
+
+    def test_existing_file_is_skipped(self):
+        with open('AAA.mods', 'w') as fp:
+            fp.write('keep')
+        self.process(['Filename\t/mods:titleInfo/mods:title', 'AAA\tA photo', 'BBB\tSwan Lake'])
+        self.assertEqual('keep', self.read('AAA.mods'))
+        self.assertIn('<mods:title>Swan Lake</mods:title>', self.read('BBB.mods'))
+
+    def test_blank_lines_are_skipped(self):
+        self.process(['Filename\t/mods:titleInfo/mods:title', '', 'AAA\tA photo', '', 'BBB\tSwan Lake', ''])
+        self.assertEqual(['AAA.mods', 'BBB.mods'], sorted(f for f in os.listdir('.') if f.endswith('.mods')))
+
+    def test_long_value(self):
+        self.process(['Filename\t/mods:note', 'AAA\t' + 'x' * 200000, 'BBB\tshort'])
+        self.assertIn('x' * 200000, self.read('AAA.mods'))
+        self.assertIn('<mods:note>short</mods:note>', self.read('BBB.mods'))
+
+    def test_quotes_stay_on_one_line(self):
+        self.process(['Filename\t/mods:note', 'AAA\t"unbalanced', 'BBB\t"quoted"'])
+        self.assertIn('<mods:note>unbalanced</mods:note>', self.read('AAA.mods'))
+        self.assertIn('<mods:note>quoted</mods:note>', self.read('BBB.mods'))
+
+    def test_rows_before_a_decode_error_are_written(self):
+        for overwrite in (False, True):
+            tsv2mods.overwrite = overwrite
+            with open('input.tsv', 'wb') as fp:
+                fp.write(b'Filename\t/mods:note\n')
+                fp.write(b''.join('r{}\tnote\n'.format(n).encode() for n in range(3000)))
+                fp.write(b'bad\t\xff\n')
+            with mock.patch('os.cpu_count', return_value=4), mock.patch('builtins.print'):
+                tsv2mods.process_file(os.path.abspath('input.tsv'))
+            self.assertTrue(os.path.exists('r0.mods'))
+            self.assertFalse(os.path.exists('bad.mods'))
+
+    def test_rows_before_a_read_error_are_written(self):
+        limit = csv.field_size_limit(1000)
+        try:
+            for overwrite in (False, True):
+                tsv2mods.overwrite = overwrite
+                with mock.patch('csv.field_size_limit'), mock.patch('builtins.print'):
+                    self.process(['Filename\t/mods:note', 'AAA\tfirst', 'BBB\t' + 'x' * 2000, 'CCC\tlast'])
+                self.assertTrue(os.path.exists('AAA.mods'))
+                self.assertFalse(os.path.exists('CCC.mods'))
+        finally:
+            csv.field_size_limit(limit)
+
+    def test_empty_attribute_value(self):
+        self.process(['Filename\t/mods:note@type=', 'AAA\ta note'])
+        self.assertIn('<mods:note type="">a note</mods:note>', self.read('AAA.mods'))
+
+    def test_bad_header(self):
+        with mock.patch('builtins.print') as mock_print:
+            self.process(['Filename\t/mods:titleInfo/mods:title\t/mods:note@type', 'AAA\tA photo\tnote'])
+        self.assertIn('column 3 /mods:note@type', mock_print.call_args[0][0])
+        self.assertFalse(os.path.exists('AAA.mods'))
+
+    def test_empty_file(self):
+        self.process([])
+        self.assertEqual([], [f for f in os.listdir('.') if f.endswith('.mods')])
+
+    def test_shared_parents(self):
+        self.process(['Filename\t/mods:name/mods:namePart\t/mods:name/mods:role/mods:roleTerm@type=code\t'
+                      '/mods:relatedItem@xlink:href=%value%>Libraries Search',
+                      'dir/AAA.jpg\tSmith, Bob\tcre\tbob'])
+        self.assertIn('<mods:name><mods:namePart>Smith, Bob</mods:namePart><mods:role>'
+                      '<mods:roleTerm type="code">cre</mods:roleTerm></mods:role></mods:name>'
+                      '<mods:relatedItem xlink:href="bob">Libraries Search</mods:relatedItem>', self.read('AAA.mods'))
+
+    def test_first_parent_in_document_order(self):
+        self.process(['Filename\t/mods:name@type=x\t/mods:name@type=y/mods:namePart\t'
+                      '/mods:name/mods:namePart@type=given\t/mods:name/mods:namePart/mods:x',
+                      'AAA\tX\tY\tG\tinner'])
+        self.assertIn('<mods:namePart type="given">G<mods:x>inner</mods:x></mods:namePart>', self.read('AAA.mods'))
+
+    def test_spawned_workers_log(self):
+        tsv2mods.setup_log('DEBUG')
+        start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+        try:
+            self.process(['Filename\t/mods:titleInfo/mods:title', 'AAA\tA photo', 'BBB\tSwan Lake'], workers=2)
+        finally:
+            multiprocessing.set_start_method(start_method, force=True)
+        self.assertEqual(2, self.read('tsv2mods.log').count('Current Filename is'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,8 +25,8 @@ If row 1 contains %value% the element value is put there instead of in the text
 If row 1 contains > then it is assumed that the text to the right of the > is added as the element text.
 
 So the above example with an element value of "bob" would create
-<mods:mods>
-  <mods:relatedItem xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="bob">UM Libraries Search</mods:relatedItem>
+<mods:mods xmlns:mods="http://www.loc.gov/mods/v3" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <mods:relatedItem xlink:href="bob">UM Libraries Search</mods:relatedItem>
 </mods:mods>
 
 Rows 2 through whatever hold the element values.
@@ -35,232 +35,393 @@ If the element value contains %blank% then the blank element is added, even with
 
 """
 import os
+import re
+import sys
 import argparse
-import codecs
+import csv
 import time
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import logging
 import logging.config
-try:
-    import lxml.etree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
+import lxml.etree as ET
 
 logger = None
 data_mapping = None
+add_columns = None
 namespaces = {
     'mods': 'http://www.loc.gov/mods/v3',
     'xlink': 'http://www.w3.org/1999/xlink'
 }
+_MODS_ROOT_TAG = '{' + namespaces['mods'] + '}mods'
+# Marks a path with more than one element in the created dict of add_path
+_SEVERAL = object()
 include_empty_tags = None
 overwrite = False
+existing_files = set()
+# element@attribute=value>common text
+_COLDEF_RE = re.compile(r'^([^@>]+)(?:@([^=]+)=([^>]*))?(?:>(.*))?$')
 
 
-def load_column_defs(line):
+def load_column_defs(columns):
     """Load the MODS Xpaths from the row of data provided
 
     Positional arguments
-    line : The row of tab separated values
+    columns : The list of values in the header row
     """
     global data_mapping
-    columns = line.split('\t')
     # Remove filename element
     columns.pop(0)
     data_mapping = []
-    for data in columns:
+    # Number each distinct path of element names, so per row lookups hash an int instead of a tuple
+    path_ids = {}
+    # Count columns from 1, including the filename
+    for column_num, data in enumerate(columns, 2):
         if len(data) > 0 and data[0] == '/':
             '''Starts with / so assume a XPath'''
             paths = data.split('/')
             path_arr = []
+            path_keys = []
+            path_finds = []
+            path_names = ()
+            shared_depth = None
             for path_part in paths:
                 if len(path_part) > 0:
-                    path_arr.append(path_part)
+                    try:
+                        element_def = parse_element(path_part)
+                    except ValueError as e:
+                        raise ValueError("column {} {}: {}".format(column_num, data, str(e)))
+                    path_arr.append(element_def)
+                    if (element_def[1] or element_def[2] is not None) and shared_depth is None:
+                        # Elements with attributes are always added new, so are their children
+                        shared_depth = len(path_arr) - 1
+                    # Each prefix of the path is keyed on its element names alone
+                    path_names += (element_def[0],)
+                    path_keys.append(path_ids.setdefault(path_names, len(path_ids)))
+                    path_finds.append('/'.join(path_names))
             if len(path_arr) > 0:
-                data_mapping.append(path_arr)
+                if shared_depth is None:
+                    shared_depth = len(path_arr)
+                data_mapping.append((path_arr, path_keys, path_finds, shared_depth))
         else:
             # Its a literal placeholder
             data_mapping.append("placeholder: {}".format(data))
 
 
-def process_data(line):
+def process_data(data):
     """Process a row of spreadsheet data
 
     Positional arguments
-    line : The row of tab separated values
+    data : The list of values in the row
     """
     # Create a starting mods
-    root = ET.Element(add_namespaces('mods:mods'))
-    mods = ET.ElementTree(root)
-    # Split data on tabs
-    data = line.split('\t')
+    root = ET.Element(_MODS_ROOT_TAG, nsmap=namespaces)
     # Take the filename in column one to make the output file name
-    filename = os.path.splitext(os.path.split(data.pop(0))[1])[0] + ".mods"
-    if os.path.exists(os.path.join(os.getcwd(), filename)) and not overwrite:
+    filename = mods_filename(data.pop(0))
+    if not overwrite and filename in existing_files:
         return
-    column_num = 0
-    logger.debug("\nCurrent Filename is {}".format(filename))
+    # Elements added to this document keyed by the id of their path of element names
+    created = {}
+    add_columns(data, root, created)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("\nCurrent Filename is %s\n%s", filename, ET.tostring(root, encoding='unicode'))
+    # The document is only written once the row is done, as any later column can add to an earlier element.
+    document = ET.tostring(root, encoding="UTF-8", xml_declaration=True, method='xml')
     try:
-        for column in data:
-            column = column.strip('"')
-            working_map = data_mapping[column_num]
-            logger.debug("working_map is {}".format(working_map))
-            if working_map[0:11] != "placeholder" and (len(column) > 0 or include_empty_tags):
-                element = working_map[len(working_map)-1]
-                logger.debug("trying to add {} to parents {}".format(element, working_map))
-                the_element = find_element(working_map, mods, column)
-                logger.debug("Got back the_element {} adding value {}".format(the_element, column))
-            column_num += 1
-    except IndexError:
-        # No more elements
-        logger.debug("No more elements in working maps")
-        pass
-    mods.write(filename, encoding="utf-8", xml_declaration=True, method='xml')
+        # O_BINARY stops Windows from translating newlines
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0) | (os.O_TRUNC if overwrite else os.O_EXCL)
+        fd = os.open(filename, flags, 0o666)
+    except FileExistsError:
+        # The file was created since the existing files were listed
+        logger.debug("Skipping %s, it already exists", filename)
+        return
+    try:
+        # os.write may not write everything at once
+        view = memoryview(document)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
      
-def find_element(element, mods, element_value=None):
-    """Find the mods Xpath in the existing document
+def make_add_columns(empty_tags, column_defs):
+    """Make the function that adds a row's values to its document, specialized on whether empty values are added
 
     Positional arguments
-    element : the list of elements to search for
-    mods : the ElementTree object
+    empty_tags : whether to add elements for empty values
+    column_defs : the column definitions from load_column_defs
     """
-    search_term = '/'.join(make_searchable(element[:]))
-    if search_term[0] == '/':
-        search_term = search_term[1:]
-    logger.debug("Search for {}".format(search_term))
-    search = mods.find(search_term, namespaces=namespaces)
-    if search is None:
-        try:
-            logger.debug("Length of element {}".format(len(element)))
-            # Toss the last element
-            logger.debug("element is {}".format(element))
-            this_element = element[-1]
-            if len(element[:-1]) > 0:
-                logger.debug("element has {} elements".format(len(element[:-1])))
-                parent = find_element(element[:-1], mods)
-            else:
-                logger.debug("There is nothing left, adding to root")
-                parent = mods.getroot()
-            return add_element(this_element, parent, element_value=element_value)
-        except IndexError:
-            parent = mods.getroot()
-            return add_element(element, parent)
+    # Placeholder columns are never added, so only keep the XPath columns and their position in the row
+    column_maps = [(column_num, working_map) for column_num, working_map in enumerate(column_defs)
+                   if isinstance(working_map, tuple)]
+
+    if empty_tags:
+        def add_columns(data, root, created):
+            row_length = len(data)
+            for column_num, working_map in column_maps:
+                if column_num >= row_length:
+                    break
+                add_path(working_map, root, created, data[column_num].strip('"'))
     else:
-        return search
+        def add_columns(data, root, created):
+            row_length = len(data)
+            for column_num, working_map in column_maps:
+                if column_num >= row_length:
+                    break
+                column = data[column_num].strip('"')
+                if len(column) > 0:
+                    add_path(working_map, root, created, column)
+    return add_columns
+
+
+def mods_filename(value):
+    """Make the output filename from the first column, the last part of the path with its extension replaced by .mods
+
+    Positional arguments
+    value : the value from the first column
+    """
+    cut = value.rfind(os.sep)
+    if os.altsep:
+        # Windows, also split on / and drop any drive
+        value = os.path.splitdrive(value)[1]
+        cut = max(value.rfind(os.sep), value.rfind(os.altsep))
+    base = value[cut + 1:]
+    dot = base.rfind('.')
+    # Like os.path.splitext leading dots do not start an extension
+    if dot > 0 and base[:dot].lstrip('.'):
+        base = base[:dot]
+    return base + ".mods"
+
+
+def add_path(working_map, root, created, element_value=None):
+    """Add the elements of a column's path to the document, reusing existing parents
+
+    Positional arguments
+    working_map : tuple of the list of elements, their path keys, their find paths and how deep they can be shared
+    root : the root mods Element
+    created : dict of elements already added to this document keyed by path id
+    """
+    path_arr, path_keys, path_finds, shared_depth = working_map
+    parent = root
+    last = len(path_arr) - 1
+    for depth, element_def in enumerate(path_arr):
+        key = path_keys[depth]
+        element = None
+        if depth < shared_depth:
+            element = created.get(key)
+            if element is _SEVERAL:
+                # The first match in document order is not always the first one added, so search for it
+                element = root.find(path_finds[depth])
+        if element is None:
+            element = add_element(element_def, parent, element_value=element_value if depth == last else None)
+            created[key] = _SEVERAL if key in created else element
+        parent = element
+    return parent
 
 
 def add_element(element_def, parent, element_value=None):
     """Add an element a parent
         
     Arguments:
-    element_def : the string of the element to add
+    element_def : the parsed element to add, from parse_element
     element_value : value to add to the element or None.
     parent : the parent to append this element to.
     """
-    attributes = {}
-    common_element_value = None
+    tag, attributes, value_key, common_element_value = element_def
     if element_value is not None:
-        element_value = element_value.lstrip(' ').rstrip(' ')
+        element_value = element_value.strip(' ')
     # If we want to force a blank element.
     if element_value == '%blank%':
         element_value = None
-    if element_def.find('>') > -1:
-        # We have a common element value, probably using the value in an attribute
-        element_def, common_element_value = element_def.split('>')
-    if element_def.find("@") > -1:
-        element_def, attrib = element_def.split("@")
-        key, val = attrib.split("=")
-        key = add_namespaces(key)
-        val = val.rstrip('"\'').lstrip('"\'')
-        if '%value%' in val:
-            attributes[key] = element_value
-            element_value = None
-            if common_element_value is not None:
-                element_value = common_element_value
-        else:
-            attributes[key] = val
-    ele = ET.SubElement(parent, add_namespaces(element_def), attributes)
+    if value_key is not None:
+        attributes = {value_key: element_value}
+        # We may have a common element value, probably using the value in an attribute
+        element_value = common_element_value
+    ele = ET.SubElement(parent, tag, attributes)
     if element_value is not None:
         ele.text = element_value
     return ele
 
 
-def make_searchable(terms):
-    """Change the element creation string into a XPath searchable one.
-    
-    Examples:   /foo/bar => /mods:foo/mods:bar
-                /foo/bar@kids=2 => /mods:foo/mods:bar[@kids="2"]
+def parse_element(element_def):
+    """Parse an element creation string from the column definitions.
+
+    Returns a tuple of the expanded tag, the dict of fixed attributes, the expanded name of the attribute that
+    takes the element value or None and the common element text or None.
+
+    Examples:   mods:form@type=medium => ('{...}form', {'type': 'medium'}, None, None)
+                mods:relatedItem@xlink:href=%value%>Search => ('{...}relatedItem', {}, '{...}href', 'Search')
     Arguments:
-    terms : the list of elements to search for, the element argument from find_element
+    element_def : the string of the element
     """
-    try:
-        logger.debug("make_searchable: terms is {}".format(terms))
-        this_term = terms.pop()
-        if this_term.find("@") > -1:
-            x, y = this_term.split("@")
-            a, b = y.split("=")
-            b = b.lstrip('\'"').rstrip('\'"')
-            a = add_namespaces(a)
-            if '%value%' in b:
-                y = "[" + a + "]"
-            else:
-                y = "[" + a + "=\"" + b + "\"]"
-            this_term = add_namespaces(x) + y
+    match = _COLDEF_RE.match(element_def)
+    if match is None:
+        raise ValueError("Unable to parse element definition {}".format(element_def))
+    tag, key, val, common_element_value = match.groups()
+    # SubElement copies the attributes, so the same dict is shared by every row
+    attributes = {}
+    value_key = None
+    if key is not None:
+        key = add_namespaces(key)
+        val = val.strip('"\'')
+        if '%value%' in val:
+            value_key = key
         else:
-            this_term = add_namespaces(this_term)
-        logger.debug("this_term is now {}".format(this_term))
-        search_terms = make_searchable(terms)
-        search_terms.append(this_term)
-        logger.debug("make_searchable: l is {}".format(search_terms))
-        return search_terms
-    except IndexError:
-        return list()
+            attributes[key] = val
+    return add_namespaces(tag), attributes, value_key, common_element_value
 
 
-def add_namespaces(object):
+_ns_cache = {}
+
+
+def add_namespaces(object, _cache=_ns_cache):
     """Adds expanded namespace, assumes mods if not defined"""
-    if ':' in object:
-        key, element = object.split(':')
-        key_namespace = namespaces[key]
-        return '{' + key_namespace + '}' + element
-    return object
+    expanded = _cache.get(object)
+    if expanded is None:
+        expanded = object
+        key, sep, element = object.partition(':')
+        if sep:
+            key_namespace = namespaces[key]
+            expanded = '{' + key_namespace + '}' + element
+        # Interned as these names are used as tags and attribute keys for every row
+        expanded = sys.intern(expanded)
+        _cache[object] = expanded
+    return expanded
+
+
+def init_worker(settings):
+    """Setup a worker process to convert rows
+
+    Positional arguments
+    settings : tuple of the column definitions, whether to include empty tags, whether to overwrite files,
+               the set of MODS files that already exist and the logging level
+    """
+    global logger, data_mapping, include_empty_tags, overwrite, existing_files, add_columns
+    data_mapping, include_empty_tags, overwrite, existing_files, log_level = settings
+    logger = logging.getLogger('tsv2mods')
+    if not logger.handlers:
+        # Spawned workers don't inherit the logging setup, append to the log file started by the parent
+        setup_log(log_level, 'a')
+    add_columns = make_add_columns(include_empty_tags, data_mapping)
+
+
+def read_rows(fp, report_errors=True):
+    """Read the rows after the header, stopping at the first line that can't be read
+
+    Positional arguments
+    fp : the open TSV file, read from the start
+    report_errors : whether to print the error that stopped the reading
+    """
+    fp.seek(0)
+    # Each line is one row, quotes are stripped from the values instead of spanning lines
+    reader = csv.reader(fp, dialect='excel-tab', quoting=csv.QUOTE_NONE)
+    try:
+        # Skip the header
+        next(reader, None)
+        for row in reader:
+            if not row:
+                # Blank line
+                continue
+            yield row
+    except UnicodeDecodeError as e:
+        if report_errors:
+            print("Error decoding character after line {}: {}".format(reader.line_num, str(e)))
+    except csv.Error as e:
+        if report_errors:
+            print("Error reading line {}: {}".format(reader.line_num, str(e)))
+
+
+def written_rows(fp):
+    """Yield one row for each output filename: the last when overwriting, otherwise the first.
+
+    Rows with the same filename would race each other in the workers.
+
+    Positional arguments
+    fp : the open TSV file
+    """
+    if overwrite:
+        # Find the last row for each filename first
+        last_rows = {}
+        for row_num, row in enumerate(read_rows(fp, report_errors=False)):
+            last_rows[mods_filename(row[0])] = row_num
+        for row_num, row in enumerate(read_rows(fp)):
+            if last_rows.get(mods_filename(row[0])) == row_num:
+                yield row
+    else:
+        seen = set()
+        for row in read_rows(fp):
+            output_filename = mods_filename(row[0])
+            if output_filename not in seen:
+                seen.add(output_filename)
+                yield row
+
+
+def list_existing_files():
+    """List the MODS files in the current directory"""
+    return {f for f in os.listdir(os.getcwd()) if f.endswith('.mods')}
 
 
 def process_file(filename):
     """Process a spreadsheet"""
-    for prefix, uri in namespaces.items():
-        ET.register_namespace(prefix, uri)
     if os.path.exists(filename):
+        # Values can be any length, use the largest limit csv accepts on every platform
+        csv.field_size_limit(2 ** 31 - 1)
         try:
-            with codecs.open(filename, 'r', encoding='utf8') as fp:
-                load_column_defs(fp.readline().rstrip("\r\n"))
+            with open(filename, 'r', encoding='utf-8', newline='', buffering=1 << 20) as fp:
                 try:
-                    # Start counter on the next line.
-                    line_number = 2
-                    for line in fp:
-                        logger.debug("Operate on line {}".format(line.rstrip("\r\n")))
-                        process_data(line.rstrip("\r\n"))
-                        line_number += 1
-                except UnicodeDecodeError as e:
-                    print("Error decoding character on line {}: {}".format(line_number, str(e)))
+                    header = next(csv.reader(fp, dialect='excel-tab', quoting=csv.QUOTE_NONE), None)
+                except (UnicodeDecodeError, csv.Error) as e:
+                    print("Error reading the header of {}: {}".format(filename, str(e)))
+                    return
+                if header is None:
+                    # Empty file
+                    return
+                try:
+                    load_column_defs(header)
+                except ValueError as e:
+                    print("Error in the header of {}, {}".format(filename, str(e)))
+                    return
+                # List the existing output files once instead of checking for each row.
+                settings = (data_mapping, include_empty_tags, overwrite, set() if overwrite else list_existing_files(),
+                            logging.getLevelName(logger.level))
+                workers = os.cpu_count()
+                # executor.map submits everything it is given, so send the rows in batches to bound memory.
+                batch_size = 64 * 4 * workers
+                rows = written_rows(fp)
+                # Each row writes its own file, so spread them across processes.
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                         initargs=(settings,)) as executor:
+                    while True:
+                        batch = list(islice(rows, batch_size))
+                        if not batch:
+                            break
+                        if logger.isEnabledFor(logging.DEBUG):
+                            for row in batch:
+                                logger.debug("Operate on line %s", row)
+                        for _ in executor.map(process_data, batch, chunksize=64):
+                            pass
         except IOError as e:
             print("Error reading file {} : {}".format(filename, str(e)))
 
 
-def format_time(seconds):
-    """Format seconds"""
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    return "%d:%02d:%02d" % (h, m, s)
-
+def setup_log(level, mode='w'):
+    """Setup logging
 
-def setup_log(level):
-    """Setup logging"""
+    Positional arguments
+    level : the name of the logging level
+    mode : the mode to open the log file with
+    """
     global logger
     logger = logging.getLogger('tsv2mods')
     logger.propogate = False
     # Logging Level 
-    eval('logger.setLevel(logging.{})'.format(level))
-    fh = logging.FileHandler(os.path.join(os.getcwd(), 'tsv2mods.log'), 'w', 'utf-8')
+    logger.setLevel(getattr(logging, level))
+    if level in ('ERROR', 'CRITICAL'):
+        # Nothing is logged at these levels, so don't create the log file
+        logger.addHandler(logging.NullHandler())
+        return
+    fh = logging.FileHandler(os.path.join(os.getcwd(), 'tsv2mods.log'), mode, 'utf-8')
     formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
@@ -293,6 +454,6 @@ if __name__ == '__main__':
         parser.error("{} could not be resolved to a TSV file".format(args.files))
     
     total_time = time.perf_counter() - start_time
-    message = "Finished in {}".format(format_time(total_time))
+    message = "Finished in {}".format(timedelta(seconds=int(total_time)))
     logger.info(message)
     print(message)